@@ -2,11 +2,11 @@ import streamlit as st
 import sqlite3
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 import folium
 from streamlit_folium import st_folium
 from datetime import datetime, timedelta
-import os
-import json
+import orjson
 
 # --- 頁面設定 ---
 st.set_page_config(
@@ -15,112 +15,372 @@ st.set_page_config(
     layout="wide"
 )
 
+# --- 地圖標記 ---
+MAP_CENTER = [23.973, 120.979] # 台灣中心點
+MARKER_COLUMNS = ['lat', 'lon', 'location', 'max_temp', 'min_temp', 'description']
+
 # --- 資料庫設定與自動生成 ---
 DB_FILE = 'data.db'
 JSON_FILE = 'F-A0010-001.json'
+# 資料庫結構版本，結構變更時遞增以觸發重建
+SCHEMA_VERSION = 2
+
+# 模擬經緯度數據 (寫入 locations 資料表)
+MOCK_COORDS = {
+    '北部地區': [25.033, 121.565], '中部地區': [24.148, 120.674],
+    '南部地區': [22.999, 120.213], '東北部地區': [24.746, 121.745],
+    '東部地區': [23.987, 121.604], '東南部地區': [22.75, 121.15]
+}
 
 def setup_database():
     """
-    檢查資料庫是否存在，如果不存在，則建立並從JSON檔案填充它。
+    檢查資料庫的結構版本 (PRAGMA user_version)，若低於 SCHEMA_VERSION，則重新建立並從JSON檔案填充它。
     """
-    if not os.path.exists(DB_FILE):
-        st.info("正在建立並初始化資料庫... 這只需要在首次啟動時執行。")
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return True
+
+        # 整個重建在單一交易中完成，失敗時不會留下半成品；
+        # BEGIN IMMEDIATE 先取得寫入鎖，避免多個工作階段同時重建
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("BEGIN IMMEDIATE")
+
+        # 取得鎖之後再檢查一次，其他工作階段可能已完成重建
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return True
+
+        st.info("正在建立並初始化資料庫... 這只需要在首次啟動或資料庫結構更新時執行。")
         
-        # 1. 建立資料庫表格 (來自 create_db.py)
-        conn = sqlite3.connect(DB_FILE)
+        # 1. 建立資料庫表格 (來自 create_db.py)，先移除舊版本的表格
         cursor = conn.cursor()
+        for table in ('weather', 'locations', 'weather_daily_stats'):
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS weather (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             location TEXT,
             min_temp REAL,
             max_temp REAL,
-            description TEXT
+            description TEXT,
+            day_offset INTEGER NOT NULL
         )
         ''')
-        conn.commit()
-        
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_weather_offset_loc ON weather(day_offset, location)")
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS locations (
+            name TEXT PRIMARY KEY,
+            lat REAL,
+            lon REAL
+        )
+        ''')
+        cursor.executemany(
+            "INSERT OR REPLACE INTO locations (name, lat, lon) VALUES (?, ?, ?)",
+            [(name, lat, lon) for name, (lat, lon) in MOCK_COORDS.items()],
+        )
+
         # 2. 從 JSON 填充資料 (來自 process_data.py)
-        try:
-            with open(JSON_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-
-            for location in data['cwaopendata']['resources']['resource']['data']['agrWeatherForecasts']['weatherForecasts']['location']:
-                location_name = location['locationName']
-                min_temp = float(location['weatherElements']['MinT']['daily'][0]['temperature'])
-                max_temp = float(location['weatherElements']['MaxT']['daily'][0]['temperature'])
-                description = location['weatherElements']['Wx']['daily'][0]['weather']
-
-                if location_name and min_temp is not None and max_temp is not None and description:
-                    cursor.execute('''
-                    INSERT INTO weather (location, min_temp, max_temp, description)
-                    VALUES (?, ?, ?, ?)
-                    ''', (location_name, min_temp, max_temp, description))
-            
-            conn.commit()
-            st.success("資料庫已成功建立並填充資料！")
-        except FileNotFoundError:
-            st.error(f"錯誤：找不到 '{JSON_FILE}'。請確保此檔案與 app.py 在同一個目錄下。")
-            return False
-        except Exception as e:
-            st.error(f"處理JSON或資料庫時發生錯誤：{e}")
-            return False
-        finally:
-            conn.close()
-    return True
+        with open(JSON_FILE, 'rb') as f:
+            data = orjson.loads(f.read())
+
+        locations = data['cwaopendata']['resources']['resource']['data']['agrWeatherForecasts']['weatherForecasts']['location']
+        rows = [
+            (
+                location['locationName'],
+                float(location['weatherElements']['MinT']['daily'][0]['temperature']),
+                float(location['weatherElements']['MaxT']['daily'][0]['temperature']),
+                location['weatherElements']['Wx']['daily'][0]['weather'],
+            )
+            for location in locations
+        ]
+        rows = [row for row in rows if row[0] and row[3]]
+
+        # 模擬日期數據：依序分配為今天起算的第 0~2 天，只存天數，查詢時才換算成日期
+        rows = [row + (i % 3,) for i, row in enumerate(rows)]
+
+        # 以 executemany 批次寫入，避免逐筆 INSERT 的額外負擔
+        cursor.executemany('''
+        INSERT INTO weather (location, min_temp, max_temp, description, day_offset)
+        VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+
+        # 3. 預先彙總每個地區每日的溫度，供統計指標直接讀取
+        cursor.execute('''
+        CREATE TABLE weather_daily_stats AS
+        SELECT location, day_offset, SUM(max_temp) AS sum_max, SUM(min_temp) AS sum_min, COUNT(*) AS n
+        FROM weather
+        GROUP BY location, day_offset
+        ''')
+        cursor.execute("CREATE INDEX idx_daily_stats_offset_loc ON weather_daily_stats(day_offset, location)")
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+
+        # 舊的唯讀連線與查詢結果都對應到重建前的資料庫
+        get_conn.clear()
+        st.cache_data.clear()
+        st.success("資料庫已成功建立並填充資料！")
+        return True
+    except FileNotFoundError:
+        st.error(f"錯誤：找不到 '{JSON_FILE}'。請確保此檔案與 app.py 在同一個目錄下。")
+        return False
+    except Exception as e:
+        st.error(f"處理JSON或資料庫時發生錯誤：{e}")
+        return False
+    finally:
+        conn.close()
 
 # --- 資料載入與處理 ---
-@st.cache_data
+@st.cache_resource
+def get_conn():
+    """
+    建立所有查詢共用的唯讀 SQLite 連線，整個應用程式只建立一次。
+    寫入只發生在 setup_database 自己的連線中，這裡以 mmap 直接讀取資料庫檔案。
+    """
+    # 不使用 immutable=1：資料庫會在原地重建且為 WAL 模式，唯讀連線仍需經過鎖定與 WAL 才能讀到最新內容
+    conn = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA query_only=1")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def day_offset_params(start_date, end_date):
+    """
+    將日期範圍換算成相對今天的天數範圍，回傳 (今天, 起始天數, 結束天數) 作為查詢參數。
+    """
+    today = datetime.now().date()
+    return today.isoformat(), (start_date - today).days, (end_date - today).days
+
+@st.cache_data(ttl=600)
 def load_data():
+    """
+    只讀取可選的地區清單，實際資料改由 query_weather 依篩選條件查詢。
+    """
     try:
-        conn = sqlite3.connect(DB_FILE)
-        df = pd.read_sql_query("SELECT * FROM weather", conn)
-        
-        if df.empty:
+        rows = get_conn().execute('''
+            SELECT DISTINCT w.location, l.name IS NOT NULL
+            FROM weather w LEFT JOIN locations l ON w.location = l.name
+        ''').fetchall()
+
+        if not rows:
             st.error("資料庫是空的。")
-            return None, []
-            
-        # 模擬經緯度數據
-        mock_coords = {
-            '北部地區': [25.033, 121.565], '中部地區': [24.148, 120.674],
-            '南部地區': [22.999, 120.213], '東北部地區': [24.746, 121.745],
-            '東部地區': [23.987, 121.604], '東南部地區': [22.75, 121.15]
-        }
-        
-        df['coords'] = df['location'].map(mock_coords)
-        df = df.dropna(subset=['coords'])
+            return None
 
-        if df.empty:
+        location_options = sorted(location for location, has_coords in rows if has_coords)
+        if not location_options:
             st.warning("資料庫中的地點無法對應到任何已知座標。")
-            return pd.DataFrame(columns=['id', 'location', 'min_temp', 'max_temp', 'description', 'coords', 'lat', 'lon', 'date']), list(mock_coords.keys())
+            return list(MOCK_COORDS.keys())
+
+        return location_options
+
+    except Exception as e:
+        st.error(f"讀取資料時發生錯誤：{e}")
+        return None
+
+@st.cache_data(ttl=600)
+def query_weather(start_date, end_date, location=None):
+    """
+    在 SQL 端依日期範圍與地區篩選氣象資料，location 為 None 代表全部地區。
+    """
+    try:
+        df = pd.read_sql_query(
+            '''
+            SELECT w.location, w.min_temp, w.max_temp, w.description, l.lat, l.lon
+            FROM weather w JOIN locations l ON w.location = l.name
+            WHERE w.day_offset BETWEEN ? AND ? AND (? IS NULL OR w.location = ?)
+            ''',
+            get_conn(),
+            params=(*day_offset_params(start_date, end_date)[1:], location, location),
+        )
+
+        # 數值欄位統一為 float32、重複的文字欄位改為 category，減少記憶體與後續向量運算的頻寬
+        return df.astype({
+            'min_temp': 'float32', 'max_temp': 'float32', 'lat': 'float32', 'lon': 'float32',
+            'location': 'category', 'description': 'category',
+        })
 
-        df = df.reset_index(drop=True)
-        coords_df = pd.DataFrame(df['coords'].tolist(), columns=['lat', 'lon'])
-        df = pd.concat([df, coords_df], axis=1)
-        
-        # 模擬日期數據
-        today = datetime.now().date()
-        df['date'] = [today + timedelta(days=i % 3) for i in range(len(df))]
-        
-        return df, sorted(list(df['location'].unique()))
-    
     except Exception as e:
         st.error(f"讀取資料時發生錯誤：{e}")
-        return None, []
+        return None
+
+@st.cache_data(ttl=600)
+def query_stats(start_date, end_date, location=None):
+    """
+    從預先彙總的 weather_daily_stats 計算篩選範圍內的平均最高溫、平均最低溫與天數。
+    """
+    try:
+        return get_conn().execute(
+            '''
+            SELECT SUM(s.sum_max) / SUM(s.n), SUM(s.sum_min) / SUM(s.n), COUNT(DISTINCT s.day_offset)
+            FROM weather_daily_stats s JOIN locations l ON s.location = l.name
+            WHERE s.day_offset BETWEEN ? AND ? AND (? IS NULL OR s.location = ?)
+            ''',
+            (*day_offset_params(start_date, end_date)[1:], location, location),
+        ).fetchone()
+
+    except Exception as e:
+        st.error(f"讀取資料時發生錯誤：{e}")
+        return None
+
+@st.cache_data(ttl=600)
+def query_detail_table(start_date, end_date, location=None):
+    """
+    在 SQL 端選取並命名詳細資料表的欄位，回傳可直接交給 st.dataframe 的 Arrow 表格。
+    """
+    try:
+        df = pd.read_sql_query(
+            '''
+            SELECT date(?, '+' || w.day_offset || ' days') AS "日期", w.location AS "地點",
+                   w.min_temp AS "最低溫", w.max_temp AS "最高溫", w.description AS "天氣概況"
+            FROM weather w JOIN locations l ON w.location = l.name
+            WHERE w.day_offset BETWEEN ? AND ? AND (? IS NULL OR w.location = ?)
+            ''',
+            get_conn(),
+            params=(*day_offset_params(start_date, end_date), location, location),
+            parse_dates=['日期'],
+        )
+
+        # 轉為 datetime.date，Arrow 會存成 date32，表格只顯示日期而不帶時間
+        df['日期'] = df['日期'].dt.date
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+    except Exception as e:
+        st.error(f"讀取資料時發生錯誤：{e}")
+        return None
+
+def cull_to_bounds(df, bounds):
+    """
+    只保留落在目前地圖可視範圍 (st_folium 回傳的 bounds) 內的資料列。
+    """
+    if not bounds or bounds['_southWest']['lat'] is None:
+        return df
+
+    south_west, north_east = bounds['_southWest'], bounds['_northEast']
+    mask = (
+        (df['lat'] >= south_west['lat']) & (df['lat'] <= north_east['lat'])
+        & (df['lon'] >= south_west['lng']) & (df['lon'] <= north_east['lng'])
+    )
+    return df[mask]
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_marker_geojson(_df, df_key):
+    """
+    將標記資料序列化為 GeoJSON，只在標記資料 (df_key) 改變時重新計算。
+    """
+    # 以欄位運算一次產生所有標記的彈出視窗內容與顏色 (根據溫度設定標記顏色)
+    # 直接使用獨立的陣列，不必為了附加欄位而複製整個 DataFrame
+    popups = (
+        "<b>地點:</b> " + _df['location'].astype(str)
+        + "<br><b>最高溫:</b> " + _df['max_temp'].astype(str)
+        + "°C<br><b>最低溫:</b> " + _df['min_temp'].astype(str)
+        + "°C<br><b>天氣:</b> " + _df['description'].astype(str)
+    )
+    colors = np.where(_df['max_temp'].to_numpy() > 30, 'orange', 'green')
+
+    # 整批資料序列化為單一 GeoJSON，由 Leaflet 建立所有標記
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                "properties": {"popup": popup, "color": color, "location": location},
+            }
+            for lat, lon, popup, color, location in zip(
+                _df['lat'].tolist(),
+                _df['lon'].tolist(),
+                popups.tolist(),
+                colors.tolist(),
+                _df['location'].astype(str).tolist(),
+            )
+        ],
+    }
+
+def build_marker_layer(geojson):
+    """
+    建立包含所有標記的圖層。folium 物件在 st_folium 渲染時會被修改，因此每次執行都重新建立。
+    """
+    layer = folium.FeatureGroup(name="氣象站點")
+    folium.GeoJson(
+        geojson,
+        marker=folium.CircleMarker(radius=5, fill=True, fill_opacity=0.8),
+        style_function=lambda feature: {
+            'color': feature['properties']['color'],
+            'fillColor': feature['properties']['color'],
+        },
+        popup=folium.GeoJsonPopup(fields=['popup'], labels=False, max_width=200),
+        tooltip=folium.GeoJsonTooltip(fields=['location'], labels=False),
+    ).add_to(layer)
+
+    return layer
+
+@st.fragment
+def render_map(filtered_df):
+    """
+    地圖區塊。作為 fragment 執行，地圖互動只會重新執行這個區塊。
+    """
+    st.subheader("氣象站點地圖")
+    # 只繪製上次互動後可視範圍內的標記；bounds 取自 st_folium 存在 session_state 的回傳值，
+    # 地圖本身不會重建，平移或縮放才會觸發重新執行
+    map_state = st.session_state.get("weather_map")
+    visible_df = cull_to_bounds(filtered_df, map_state.get("bounds") if map_state else None)
+    map_key = pd.util.hash_pandas_object(visible_df[MARKER_COLUMNS], index=False).values.tobytes()
+
+    # 在 Streamlit 中顯示地圖，標記圖層以 feature_group_to_add 動態更新
+    st_folium(
+        folium.Map(location=MAP_CENTER, zoom_start=7),
+        feature_group_to_add=build_marker_layer(build_marker_geojson(visible_df, map_key)),
+        returned_objects=["bounds"],
+        key="weather_map",
+        width=700,
+        height=500,
+    )
+
+@st.fragment
+def render_metrics(start_date, end_date, location):
+    """
+    右側數據欄。農業資訊 checkbox 放在這個 fragment 內，切換時不會重建地圖。
+    """
+    st.subheader("數據統計")
     
-    finally:
-        if 'conn' in locals():
-            conn.close()
+    # 計算統計值 (在 SQL 端彙總)
+    stats = query_stats(start_date, end_date, location)
+    if stats is None or None in stats[:2]:
+        st.info("在此篩選條件下無統計資料。")
+        return
+    avg_max_temp, avg_min_temp, n_days = stats
+    
+    # 模擬農業數據
+    gdd_base = 10 # 生長基溫假設為 10°C
+    avg_temp = (avg_max_temp + avg_min_temp) / 2
+    gdd = max(0, avg_temp - gdd_base) * n_days # 乘以天數
+    
+    # 模擬濕度數據 (每個工作階段只產生一次，重新執行時保持不變)
+    if "humidity" not in st.session_state:
+        st.session_state.humidity = float(np.random.default_rng(42).uniform(60, 95))
+    mock_humidity = st.session_state.humidity
+
+    st.metric(label="平均最高溫", value=f"{avg_max_temp:.1f} °C")
+    st.metric(label="平均最低溫", value=f"{avg_min_temp:.1f} °C")
+
+    # 農業資訊 Checkbox
+    show_degree_day = st.checkbox("顯示農業資訊 (Degree Day)", value=True)
+    
+    if show_degree_day:
+        st.markdown("---")
+        st.subheader("農業專用指標 (模擬)")
+        st.metric(label="平均度日 (GDD)", value=f"{gdd:.1f}", help="生長度日 (Growing Degree Days)，計算方式: (平均溫度 - 生長基溫) * 天數")
+        st.metric(label="最大累積濕度/溫度", value=f"{mock_humidity:.1f} %")
 
 # --- 主程式流程 ---
 if not setup_database():
     st.stop() # 如果資料庫設定失敗，則停止執行
 
-df, location_options = load_data()
+location_options = load_data()
 
-if df is not None:
-    if not df.empty:
-        st.success("已載入氣象資料！")
+if location_options is not None:
+    st.success("已載入氣象資料！")
     
     # --- 側邊欄 (Sidebar) ---
     with st.sidebar:
@@ -152,85 +412,30 @@ if df is not None:
             index=0
         )
 
-        # 3. 農業資訊 Checkbox
-        show_degree_day = st.checkbox("顯示農業資訊 (Degree Day)", value=True)
-
     # --- 主畫面 (Main Area) ---
     st.title("一週農業氣象預報 + 農業積溫資料")
 
-    # 資料篩選
-    if selected_location == "全部地區":
-        filtered_df = df[(df['date'] >= start_date) & (df['date'] <= end_date)]
-    else:
-        filtered_df = df[(df['location'] == selected_location) & (df['date'] >= start_date) & (df['date'] <= end_date)]
+    # 資料篩選 (在 SQL 端進行)
+    location = None if selected_location == "全部地區" else selected_location
+    filtered_df = query_weather(start_date, end_date, location)
 
-    if filtered_df.empty:
+    if filtered_df is None or filtered_df.empty:
         st.warning("在此篩選條件下無資料。")
     else:
         # 版面配置：左欄寬，右欄窄
         col1, col2 = st.columns([3, 1.5])
 
         with col1:
-            # --- 地圖區塊 ---
-            st.subheader("氣象站點地圖")
-            map_center = [23.973, 120.979] # 台灣中心點
-            
-            # 建立 Folium 地圖
-            m = folium.Map(location=map_center, zoom_start=7)
-
-            # 在地圖上加上標記
-            for _, row in filtered_df.iterrows():
-                if pd.notna(row['lat']) and pd.notna(row['lon']):
-                    # 根據溫度設定標記顏色
-                    temp_color = "orange" if row['max_temp'] > 30 else "green"
-                    
-                    popup_html = f"""
-                    <b>地點:</b> {row['location']}<br>
-                    <b>最高溫:</b> {row['max_temp']}°C<br>
-                    <b>最低溫:</b> {row['min_temp']}°C<br>
-                    <b>天氣:</b> {row['description']}
-                    """
-                    
-                    folium.Marker(
-                        location=[row['lat'], row['lon']],
-                        popup=folium.Popup(popup_html, max_width=200),
-                        tooltip=row['location'],
-                        icon=folium.Icon(color=temp_color, icon="cloud"),
-                    ).add_to(m)
-
-            # 在 Streamlit 中顯示地圖
-            st_folium(m, width=700, height=500)
+            render_map(filtered_df)
 
         with col2:
-            # --- 右側數據欄 (Metrics) ---
-            st.subheader("數據統計")
-            
-            # 計算統計值
-            avg_max_temp = filtered_df['max_temp'].mean()
-            avg_min_temp = filtered_df['min_temp'].mean()
-            
-            # 模擬農業數據
-            gdd_base = 10 # 生長基溫假設為 10°C
-            avg_temp = (avg_max_temp + avg_min_temp) / 2
-            gdd = max(0, avg_temp - gdd_base) * (len(filtered_df.date.unique())) # 乘以天數
-            
-            # 模擬濕度數據
-            mock_humidity = np.random.uniform(60, 95)
-
-            st.metric(label="平均最高溫", value=f"{avg_max_temp:.1f} °C")
-            st.metric(label="平均最低溫", value=f"{avg_min_temp:.1f} °C")
-            
-            if show_degree_day:
-                st.markdown("---")
-                st.subheader("農業專用指標 (模擬)")
-                st.metric(label="平均度日 (GDD)", value=f"{gdd:.1f}", help="生長度日 (Growing Degree Days)，計算方式: (平均溫度 - 生長基溫) * 天數")
-                st.metric(label="最大累積濕度/溫度", value=f"{mock_humidity:.1f} %")
+            render_metrics(start_date, end_date, location)
 
         # 顯示詳細資料表格
         st.subheader("詳細氣象資料")
-        st.dataframe(filtered_df[['date', 'location', 'min_temp', 'max_temp', 'description']].rename(columns={
-            'date': '日期', 'location': '地點', 'min_temp': '最低溫', 'max_temp': '最高溫', 'description': '天氣概況'
-        }))
+        detail_table = query_detail_table(start_date, end_date, location)
+        if detail_table is not None:
+            st.dataframe(detail_table)
 
 else:
     st.info("正在等待資料載入...")
\ No newline at end of file